@@ -1,19 +1,72 @@
 import subprocess
 import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+import base64
+import hashlib
+import html
 import json
+import re
+import shutil
+import threading
+import zipfile
 import ebooklib
+from ebooklib import epub
 import argparse
+import importlib.util
 import openai
+from lxml import etree # Installed with ebooklib
 import os # Added os module for environment variables
 from docling.document_converter import DocumentConverter, PdfFormatOption # Added for PDF parsing
-from docling.datamodel.pipeline_options import PdfPipelineOptions
+from docling.datamodel.pipeline_options import AcceleratorOptions, PdfPipelineOptions, TableFormerMode
 from docling_core.types.doc import DoclingDocument, PictureItem  # For image extraction
-from PIL import Image # For saving images; docling might already provide PIL Images
+
+try:
+    import orjson # Optional: much faster JSON serialization than the stdlib encoder
+except ImportError:
+    orjson = None
+
+def dumps_json_bytes(data) -> bytes:
+    """Serializes ``data`` to 2-space indented UTF-8 JSON, using orjson when it is installed."""
+    if orjson is not None:
+        # OPT_NON_STR_KEYS matches the stdlib encoder, which converts int keys to strings
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, indent=2, ensure_ascii=False).encode("utf-8")
+
+def dumps_json_compact(data) -> str:
+    """Serializes ``data`` to JSON without any whitespace, for LLM payloads where indentation only adds tokens."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+def create_openai_client() -> openai.OpenAI:
+    """
+    Creates an OpenAI client that uses HTTP/2 when the optional h2 package is installed
+    (``pip install httpx[http2]``). Everything else keeps the SDK's defaults, including its
+    pooled keep-alive connections.
+    """
+    http_client = openai.DefaultHttpxClient(http2=importlib.util.find_spec("h2") is not None)
+    return openai.OpenAI(http_client=http_client)
+
+# Minimum free space on /dev/shm before the working directory is placed there
+SHM_MIN_FREE_BYTES = 1 << 30
+
+def get_work_dir_parent() -> str | None:
+    """
+    Returns /dev/shm when it is available with enough free space, so intermediate XHTML and
+    image files live in RAM instead of on disk. Returns None (the default temp dir) otherwise.
+    """
+    shm_dir = "/dev/shm"
+    try:
+        if os.path.isdir(shm_dir) and shutil.disk_usage(shm_dir).free >= SHM_MIN_FREE_BYTES:
+            return shm_dir
+    except OSError:
+        pass
+    return None
 
 def create_epub_directories():
     """Creates the basic directory structure for the EPUB in a temporary directory."""
-    base_dir = Path(tempfile.mkdtemp())
+    base_dir = Path(tempfile.mkdtemp(prefix="pdf_to_epub_", dir=get_work_dir_parent()))
     oebps_dir = base_dir / "OEBPS"
     text_dir = oebps_dir / "Text"
     images_dir = oebps_dir / "Images"
@@ -25,41 +78,105 @@ def create_epub_directories():
 
     return base_dir
 
+# Matches the device strings AcceleratorOptions accepts: auto, cpu, mps, cuda or cuda:N
+DEVICE_RE = re.compile(r"auto|cpu|mps|cuda(?::\d+)?")
+
+def non_negative_int(value: str) -> int:
+    """argparse ``type`` for options where 0 means "disabled" and negative values are meaningless."""
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must be 0 or greater, got {number}")
+    return number
+
+def parse_device(value: str) -> str:
+    """argparse ``type`` for --device: rejects values AcceleratorOptions would fail to validate."""
+    device = value.strip().lower()
+    if not DEVICE_RE.fullmatch(device):
+        raise argparse.ArgumentTypeError(f"invalid device '{value}' (expected auto, cpu, mps, cuda or cuda:N)")
+    return device
+
+def build_pdf_pipeline_options(do_ocr: bool = True, table_mode: str = "fast", num_threads: int = 4, device: str = "auto") -> PdfPipelineOptions:
+    """
+    Builds the Docling PDF pipeline options used for parsing.
+
+    Args:
+        do_ocr: Whether to run OCR. Disabling it is much faster for PDFs with a text layer.
+        table_mode: TableFormer mode, "fast" or "accurate".
+        num_threads: Number of threads used for model inference.
+        device: Inference device ("auto", "cpu", "cuda", "cuda:N" or "mps").
+
+    Returns:
+        A configured PdfPipelineOptions instance.
+    """
+    pipeline_options = PdfPipelineOptions()
+    pipeline_options.generate_picture_images = True # Crucial for image extraction
+    pipeline_options.do_ocr = do_ocr
+    pipeline_options.table_structure_options.mode = TableFormerMode(table_mode)
+    pipeline_options.accelerator_options = AcceleratorOptions(num_threads=num_threads, device=device)
+    return pipeline_options
+
+# DocumentConverter instances keyed by their serialized pipeline options. Building a converter
+# loads the layout/table model weights, so it is done once per process and configuration.
+_CONVERTER_CACHE: dict[str, DocumentConverter] = {}
+
+def get_document_converter(pipeline_options: PdfPipelineOptions) -> DocumentConverter:
+    """
+    Returns a DocumentConverter for ``pipeline_options``, reusing a cached instance when one
+    was already built with identical options.
+    """
+    # ocr_options is declared as the base OcrOptions type, so a plain dump would drop the
+    # engine-specific fields; serialize_as_any keeps them and the type name tells engines apart
+    cache_key = f"{type(pipeline_options.ocr_options).__qualname__}:{pipeline_options.model_dump_json(serialize_as_any=True)}"
+    converter = _CONVERTER_CACHE.get(cache_key)
+    if converter is not None:
+        return converter
+
+    # Initialize DocumentConverter with these options
+    # Assuming InputFormat.PDF exists in docling.datamodel.base_models (not explicitly imported here yet)
+    # If InputFormat is not found, this line will need adjustment or further imports.
+    # For now, proceeding with the structure from docling examples.
+    try:
+        from docling.datamodel.base_models import InputFormat # Attempting to import
+    except ImportError:
+        print("Warning: InputFormat could not be imported. PDF parsing might be configured incorrectly.")
+        # Fallback or error, for now, let's assume it might work without explicit InputFormat if default
+        converter = DocumentConverter()
+    else:
+        converter = DocumentConverter(
+            format_options={
+                InputFormat.PDF: PdfFormatOption(pipeline_options=pipeline_options)
+            }
+        )
+
+    _CONVERTER_CACHE[cache_key] = converter
+    return converter
+
 # Placeholder for PDF parsing functions
-def parse_pdf_to_layout_json(pdf_path: Path, work_dir: Path) -> tuple[DoclingDocument | None, dict]:
+def parse_pdf_to_layout_json(pdf_path: Path, work_dir: Path, dump_layout: bool = False, pipeline_options: PdfPipelineOptions | None = None, converter: DocumentConverter | None = None) -> tuple[DoclingDocument | None, dict]:
     """
-    Parses the PDF file using DocumentConverter, saves its structure as layout.json,
+    Parses the PDF file using DocumentConverter, optionally saves its structure as layout.json,
     and returns the resulting DoclingDocument along with the layout data.
 
     Args:
         pdf_path: Path to the input PDF file.
         work_dir: Directory to save the layout.json file.
+        dump_layout: Whether to write layout.json for debugging. The pipeline itself only
+            uses the in-memory layout data, so this is off by default.
+        pipeline_options: Docling pipeline options. Defaults to ``build_pdf_pipeline_options()``.
+            Ignored when ``converter`` is given.
+        converter: An already-initialized DocumentConverter to reuse, e.g. when converting several
+            PDFs in one process. Defaults to the cached converter for ``pipeline_options``.
 
     Returns:
         A tuple containing the DoclingDocument instance and a dictionary of the PDF layout structure.
         Returns (None, {}) on failure.
     """
     try:
-        # Configure pipeline options to ensure picture images are generated
-        pipeline_options = PdfPipelineOptions()
-        pipeline_options.generate_picture_images = True # Crucial for image extraction
-
-        # Initialize DocumentConverter with these options
-        # Assuming InputFormat.PDF exists in docling.datamodel.base_models (not explicitly imported here yet)
-        # If InputFormat is not found, this line will need adjustment or further imports.
-        # For now, proceeding with the structure from docling examples.
-        try:
-            from docling.datamodel.base_models import InputFormat # Attempting to import
-        except ImportError:
-            print("Warning: InputFormat could not be imported. PDF parsing might be configured incorrectly.")
-            # Fallback or error, for now, let's assume it might work without explicit InputFormat if default
-            converter = DocumentConverter()
-        else:
-            converter = DocumentConverter(
-                format_options={
-                    InputFormat.PDF: PdfFormatOption(pipeline_options=pipeline_options)
-                }
-            )
+        if converter is None:
+            # Configure pipeline options to ensure picture images are generated
+            if pipeline_options is None:
+                pipeline_options = build_pdf_pipeline_options()
+            converter = get_document_converter(pipeline_options)
 
         # converter.convert() returns a ConversionResult object.
         # The actual DoclingDocument is in its 'document' attribute.
@@ -72,19 +189,26 @@ def parse_pdf_to_layout_json(pdf_path: Path, work_dir: Path) -> tuple[DoclingDoc
         docling_document = conversion_result.document # This is the actual document model
         layout_data = docling_document.export_to_sexp() # Changed from export_structure()
 
-        layout_json_path = work_dir / "layout.json"
-        with open(layout_json_path, "w") as f:
-            json.dump(layout_data, f, indent=2)
+        if dump_layout:
+            layout_json_path = work_dir / "layout.json"
+            layout_json_path.write_bytes(dumps_json_bytes(layout_data))
+            print(f"PDF layout saved to: {layout_json_path}")
 
-        print(f"PDF layout saved to: {layout_json_path}")
         # Return the DoclingDocument model, not the ConversionResult
         return docling_document, layout_data
     except Exception as e: # This will catch docling.api.errors.ConversionError too
         print(f"Error parsing PDF: {e}")
         return None, {}
 
+def get_picture_ref(pic_item) -> str | None:
+    """Returns the reference a ``PictureItem`` is addressed by in the layout data: its self_ref, or get_ref().cref as a fallback."""
+    ref = getattr(pic_item, 'self_ref', None)
+    if not ref and hasattr(pic_item, 'get_ref'):
+        ref = getattr(pic_item.get_ref(), 'cref', None)
+    return ref
+
 # The parameter below expects a ``DoclingDocument`` instance
-def extract_and_save_images(docling_document, layout_data: dict, images_output_dir: Path) -> dict:
+def extract_and_save_images(docling_document, layout_data: dict, images_output_dir: Path, png_compress_level: int = 1, max_image_dim: int | None = 1600) -> dict:
     """
     Extracts images referenced in ``layout_data`` from the provided ``DoclingDocument`` and saves them.
 
@@ -92,6 +216,10 @@ def extract_and_save_images(docling_document, layout_data: dict, images_output_d
         docling_document: The ``DoclingDocument`` instance returned by ``parse_pdf_to_layout_json``.
         layout_data: The dictionary generated from ``docling_document.export_to_sexp()``.
         images_output_dir: The directory (``OEBPS/Images``) where extracted images will be saved.
+        png_compress_level: zlib level (0-9) used by the PNG encoder. Low levels encode much faster;
+            the size difference matters little since the EPUB itself is a zip archive.
+        max_image_dim: Images whose width or height exceeds this many pixels are downscaled
+            (keeping their aspect ratio) before encoding. None keeps the native resolution.
 
     Returns:
         A dictionary mapping image reference names to their relative paths inside the EPUB.
@@ -102,53 +230,44 @@ def extract_and_save_images(docling_document, layout_data: dict, images_output_d
         print("Warning: docling_document is None or does not have 'pictures' attribute. Skipping image extraction.")
         return image_references
 
-    # Create a lookup for PictureItems by their self_ref
+    # Create a lookup for PictureItems by their self_ref, built in a single pass over a
+    # materialized tuple (docling_document.pictures may be a one-shot iterable).
     picture_item_lookup = {}
     try:
-        for pic_item in docling_document.pictures: # Use the passed DoclingDocument
-            if isinstance(pic_item, PictureItem) and hasattr(pic_item, 'self_ref'):
-                picture_item_lookup[pic_item.self_ref] = pic_item
-            elif isinstance(pic_item, PictureItem) and hasattr(pic_item, 'get_ref'):
-                 # Fallback if self_ref is not directly an attribute but accessible via get_ref().cref
-                ref_obj = pic_item.get_ref()
-                if ref_obj and hasattr(ref_obj, 'cref'):
-                    picture_item_lookup[ref_obj.cref] = pic_item
+        pictures = tuple(docling_document.pictures) # Use the passed DoclingDocument
+        picture_refs = ((get_picture_ref(pic_item), pic_item) for pic_item in pictures if isinstance(pic_item, PictureItem))
+        picture_item_lookup = {ref: pic_item for ref, pic_item in picture_refs if ref}
     except Exception as e:
         print(f"Error building picture_item_lookup: {e}. Image extraction may be incomplete.")
 
+    # Collect one save job per distinct image reference first, so the (CPU-bound) PNG encoding
+    # can run on a thread pool; Pillow releases the GIL while encoding.
+    # Pictures repeated across pages (logos, headers) are separate PictureItems with identical
+    # image data; those are saved once and share the file (duplicate ref -> ref that owns the file).
+    save_jobs = {}
+    shared_image_refs = {}
+    ref_by_content = {}
     for page in layout_data.get('pages', []):
         for element in page.get('elements', []):
             if element.get('type') == 'image':
                 img_ref = element.get('ref')
-                if not img_ref:
+                if not img_ref or img_ref in save_jobs or img_ref in shared_image_refs:
                     continue
 
                 picture_item = picture_item_lookup.get(img_ref)
 
                 if picture_item:
-                    try:
-                        # Attempt to get the PIL image object
-                        # Pass the DoclingDocument instance to get_image
-                        pil_image = picture_item.get_image(docling_document)
-
-                        if pil_image:
-                            # Sanitize img_ref to create a valid filename, e.g., replace '#' and '/'
-                            sanitized_ref = img_ref.replace("#/", "").replace("/", "_")
-                            image_filename = f"{sanitized_ref}.png" # Assuming PNG, could check mimetype
-                            image_save_path = images_output_dir / image_filename
-
-                            pil_image.save(image_save_path, format="PNG")
-
-                            # Path relative to OEBPS (parent of images_output_dir)
-                            relative_path = image_save_path.relative_to(images_output_dir.parent)
-                            image_references[img_ref] = str(relative_path)
-                            print(f"Saved image: {img_ref} to {image_save_path}")
-                        else:
-                            print(f"Warning: Could not retrieve PIL image for {img_ref} from PictureItem.")
-                    except AttributeError as ae:
-                        print(f"AttributeError extracting image for {img_ref}: {ae}. PictureItem methods might be missing or docling_document is not as expected.")
-                    except Exception as e:
-                        print(f"Error processing image {img_ref}: {e}")
+                    content_key = get_picture_content_key(picture_item)
+                    if content_key is not None:
+                        if content_key in ref_by_content:
+                            shared_image_refs[img_ref] = ref_by_content[content_key]
+                            continue
+                        ref_by_content[content_key] = img_ref
+
+                    # Sanitize img_ref to create a valid filename, e.g., replace '#' and '/'
+                    sanitized_ref = img_ref.replace("#/", "").replace("/", "_")
+                    image_filename = f"{sanitized_ref}.png" # Assuming PNG, could check mimetype
+                    save_jobs[img_ref] = (picture_item, images_output_dir / image_filename)
                 else:
                     # This case means layout.json references an image that isn't in docling_document.pictures
                     # or the ref format doesn't match.
@@ -158,8 +277,99 @@ def extract_and_save_images(docling_document, layout_data: dict, images_output_d
                     # image_bytes = get_image_with_pymupdf(pdf_path, img_ref_details_from_layout)
                     # if image_bytes: ... save ...
 
+    if not save_jobs:
+        return image_references
+
+    with ThreadPoolExecutor(max_workers=min(os.cpu_count() or 1, len(save_jobs))) as executor:
+        future_to_ref = {
+            executor.submit(
+                save_picture_image, img_ref, picture_item, docling_document,
+                image_save_path, png_compress_level, max_image_dim
+            ): (img_ref, image_save_path)
+            for img_ref, (picture_item, image_save_path) in save_jobs.items()
+        }
+        # Collected in submission (layout) order rather than completion order, so the EPUB
+        # manifest lists images in the same order on every run
+        for future in future_to_ref:
+            if future.result():
+                img_ref, image_save_path = future_to_ref[future]
+                # Path relative to OEBPS (parent of images_output_dir)
+                relative_path = image_save_path.relative_to(images_output_dir.parent)
+                image_references[img_ref] = str(relative_path)
+    # Reported once instead of per image: workers printing concurrently contend on stdout
+    print(f"Saved {len(image_references)} of {len(save_jobs)} image(s) to {images_output_dir}")
+
+    for img_ref, owner_ref in shared_image_refs.items():
+        if owner_ref in image_references:
+            image_references[img_ref] = image_references[owner_ref]
+
     return image_references
 
+def get_picture_content_key(picture_item) -> bytes | None:
+    """
+    Returns a key identifying the image data Docling embedded in ``picture_item`` (a digest of its
+    data URI), so identical pictures can be detected without decoding them or keeping a second copy
+    of their base64 data alive. Returns None if there is none.
+    """
+    image_ref = getattr(picture_item, 'image', None)
+    if image_ref is None:
+        return None
+    uri = str(image_ref.uri)
+    if not uri.startswith("data:"):
+        return None
+    return hashlib.blake2b(uri.encode("utf-8"), digest_size=16).digest()
+
+def get_embedded_png_bytes(picture_item, max_image_dim: int | None = None) -> bytes | None:
+    """
+    Returns the PNG bytes Docling embedded in ``picture_item.image`` as a base64 data URI, when they
+    can be used unchanged: the image is a PNG and does not need to be downscaled to ``max_image_dim``.
+    The size is read from the ImageRef metadata, so nothing is decoded. Returns None otherwise.
+    """
+    image_ref = getattr(picture_item, 'image', None)
+    if image_ref is None or getattr(image_ref, 'mimetype', None) != "image/png":
+        return None
+    if max_image_dim and max(image_ref.size.width, image_ref.size.height) > max_image_dim:
+        return None
+    header, _, encoded_image = str(image_ref.uri).partition(",")
+    if header != "data:image/png;base64" or not encoded_image:
+        return None
+    return base64.b64decode(encoded_image)
+
+def save_picture_image(img_ref: str, picture_item, docling_document, image_save_path: Path, png_compress_level: int, max_image_dim: int | None = None) -> bool:
+    """
+    Renders a single ``PictureItem`` to a PNG file. Runs on a worker thread of ``extract_and_save_images``,
+    which reports the saved images; only failures are printed here.
+
+    Returns:
+        True if the image was saved, False otherwise.
+    """
+    try:
+        # Docling usually already holds the picture as PNG bytes; write those as-is when possible
+        png_bytes = get_embedded_png_bytes(picture_item, max_image_dim)
+        if png_bytes is not None:
+            image_save_path.write_bytes(png_bytes)
+            return True
+
+        # Attempt to get the PIL image object
+        # Pass the DoclingDocument instance to get_image
+        pil_image = picture_item.get_image(docling_document)
+
+        if pil_image:
+            # EPUB readers display images on small screens; encoding cost grows with pixel count
+            if max_image_dim and max(pil_image.size) > max_image_dim:
+                from PIL import Image, ImageOps # Only needed for resampling; embedded PNGs are written without PIL
+                # get_image() may return the PIL image cached on the DoclingDocument, so resize into a
+                # new image rather than in place with thumbnail()
+                pil_image = ImageOps.contain(pil_image, (max_image_dim, max_image_dim), Image.Resampling.LANCZOS)
+            pil_image.save(image_save_path, format="PNG", compress_level=png_compress_level, optimize=False)
+            return True
+        print(f"Warning: Could not retrieve PIL image for {img_ref} from PictureItem.")
+    except AttributeError as ae:
+        print(f"AttributeError extracting image for {img_ref}: {ae}. PictureItem methods might be missing or docling_document is not as expected.")
+    except Exception as e:
+        print(f"Error processing image {img_ref}: {e}")
+    return False
+
 # System prompt for LLM
 SYSTEM_PROMPT = """\
 You are an expert XHTML generator. Your task is to convert a JSON representation of a single page's content into a valid XHTML 1.1 document.
@@ -198,11 +408,238 @@ Rules for converting JSON elements to XHTML:
 8.  **Valid XHTML 1.1**: Ensure the output is well-formed and valid XHTML 1.1. Pay attention to self-closing tags like `<img />` and `<link />`.
 9.  **Encoding**: The XML declaration must specify UTF-8 encoding.
 
-Process the following JSON data for one page and generate the complete XHTML file content:
+The user message contains the JSON data for one page. Generate the complete XHTML file content for it.
 """
 
+# Appended to SYSTEM_PROMPT when several pages are refined with a single request
+BATCH_SYSTEM_PROMPT = SYSTEM_PROMPT + """
+The user message is a JSON array of several pages rather than a single page. Each page object has a `page_no` field.
+Convert every page into its own complete XHTML document following all of the rules above, in the order given.
+Wrap each document in sentinel lines exactly like this, using the page's `page_no` value for n:
+<<<PAGE n>>>
+(complete XHTML document for page n)
+<<<END>>>
+Do not output anything outside of the sentinels.
+"""
+
+# Matches an LLM response wrapped in a markdown code fence (```, ```xml, ```xhtml or ```html)
+MARKDOWN_FENCE_RE = re.compile(r"^\s*```(?:xml|xhtml|html)?[ \t]*\n?(.*?)\n?```\s*$", re.DOTALL)
+
+# Matches one page of a batched LLM response (see BATCH_SYSTEM_PROMPT)
+PAGE_SENTINEL_RE = re.compile(r"<<<PAGE\s+(\d+)>>>(.*?)<<<END>>>", re.DOTALL)
+
+def prepare_page_for_llm(page_data: dict, page_number: int, image_references: dict) -> dict:
+    """
+    Returns a copy of ``page_data`` whose image refs point at the extracted image filenames.
+
+    Only image elements have their 'ref' rewritten, so this builds a shallow copy of the page
+    that shares every other element with page_data instead of deep-copying the whole page.
+    """
+    # The LLM prompt expects {{ref}} to be the filename part, e.g., "image1.png"
+    # and will construct <img src="../Images/{{ref}}"/>
+    # image_references maps: original_ref -> "Images/new_filename.png"
+    if 'elements' not in page_data:
+        return page_data
+
+    elements_for_llm = []
+    for element in page_data['elements']:
+        if element.get('type') == 'image' and element.get('ref'):
+            original_ref = element['ref']
+            if original_ref in image_references:
+                # image_references stores "Images/new_filename.png"
+                # We need to extract "new_filename.png" for the LLM prompt's {{ref}}
+                new_ref = Path(image_references[original_ref]).name
+            else:
+                # If not in map, maybe it's already a filename or a placeholder?
+                # For safety, make it just the filename if it looks like a path.
+                new_ref = Path(original_ref).name
+                print(f"Warning: Image ref '{original_ref}' for page {page_number} not found in image_references map. Using filename directly: {new_ref}")
+            element = {**element, 'ref': new_ref}
+        # If the image ref is None or empty, it will be handled by the LLM's generic rule or omitted.
+        elements_for_llm.append(element)
+    return {**page_data, 'elements': elements_for_llm}
+
+def clean_llm_xhtml(xhtml_content: str) -> str:
+    """Strips surrounding whitespace and any markdown code fence the LLM wrapped around its XHTML."""
+    fence_match = MARKDOWN_FENCE_RE.match(xhtml_content)
+    if fence_match:
+        xhtml_content = fence_match.group(1)
+    return xhtml_content.strip()
+
+def save_page_xhtml(xhtml_content: str, page_number: int, work_dir: Path) -> Path | None:
+    """
+    Writes the XHTML for one page to ``OEBPS/Text/page_NNNN.xhtml``. The Text directory must
+    already exist (see ``create_epub_directories``).
+
+    Returns:
+        Path to the written XHTML file, or None on failure.
+    """
+    xhtml_file_path = work_dir / "OEBPS" / "Text" / f"page_{page_number:04d}.xhtml"
+
+    try:
+        with open(xhtml_file_path, "w", encoding="utf-8") as f:
+            f.write(xhtml_content)
+        print(f"Saved XHTML for page {page_number} to: {xhtml_file_path}")
+        return xhtml_file_path
+    except IOError as e:
+        print(f"Error writing XHTML file for page {page_number} at {xhtml_file_path}: {e}")
+        return None
+
+# Element types, and the fields they may carry, that render_simple_page_xhtml can convert
+# without the LLM, following the same rules as SYSTEM_PROMPT
+SIMPLE_ELEMENT_TYPES = {'text', 'heading', 'image', 'list'}
+SIMPLE_ELEMENT_FIELDS = {'type', 'text', 'level', 'ref', 'items', 'bbox'}
+
+XHTML_PAGE_TEMPLATE = """\
+<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en">
+<head>
+    <title>Page Content</title>
+    <link rel="stylesheet" type="text/css" href="../Styles/style.css" />
+</head>
+<body>
+    <div class="page">
+{content}
+    </div>
+</body>
+</html>
+"""
+
+def is_simple_page(page_data: dict) -> bool:
+    """
+    Returns True if every element of the page is a plain text, heading, image or list element
+    with well-formed fields, i.e. the page can be rendered by ``render_simple_page_xhtml``.
+    """
+    for element in page_data.get('elements', []):
+        element_type = element.get('type')
+        if element_type not in SIMPLE_ELEMENT_TYPES or not element.keys() <= SIMPLE_ELEMENT_FIELDS:
+            return False
+        if element_type in ('text', 'heading') and not isinstance(element.get('text'), str):
+            return False
+        if element_type == 'heading' and not isinstance(element.get('level', 1), int):
+            return False
+        if element_type == 'image' and not element.get('ref'):
+            return False
+        if element_type == 'list' and not (isinstance(element.get('items'), list) and all(isinstance(item, str) for item in element['items'])):
+            return False
+    return True
+
+# Characters XML 1.0 does not allow even when escaped (C0 controls other than tab/newline/CR,
+# surrogates and the U+FFFE/U+FFFF non-characters). PDF text often contains form feeds.
+XML_ILLEGAL_CHARS_RE = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]")
+
+def escape_xml_text(value, quote: bool = True) -> str:
+    """Escapes ``value`` for XHTML markup, replacing characters that are illegal in XML with spaces."""
+    return html.escape(XML_ILLEGAL_CHARS_RE.sub(" ", str(value)), quote=quote)
+
+def render_simple_page_xhtml(page_data_for_llm: dict) -> str:
+    """
+    Renders a page to XHTML locally, without an LLM round-trip. Pages accepted by ``is_simple_page``
+    are converted exactly as SYSTEM_PROMPT describes; other elements get the generic representation
+    of its rule 5, which makes this usable as a fallback when the LLM output cannot be used.
+
+    Args:
+        page_data_for_llm: Page data as returned by ``prepare_page_for_llm`` (image refs are filenames).
+
+    Returns:
+        The complete XHTML document for the page.
+    """
+    content_lines = []
+    for element in page_data_for_llm.get('elements', []):
+        element_type = element.get('type')
+        text = element.get('text')
+        items = element.get('items')
+        if element_type == 'heading' and isinstance(text, str):
+            level = element.get('level', 1)
+            level = min(max(level, 1), 6) if isinstance(level, int) else 1
+            content_lines.append(f"<h{level}>{escape_xml_text(text, quote=False)}</h{level}>")
+        elif element_type == 'image' and element.get('ref'):
+            ref = escape_xml_text(element['ref'])
+            content_lines.append(f'<img src="../Images/{ref}" alt="Image {ref}" />')
+        elif element_type == 'list' and isinstance(items, list):
+            list_items = "".join(f"<li>{escape_xml_text(item, quote=False)}</li>" for item in items)
+            content_lines.append(f"<ul>{list_items}</ul>")
+        elif isinstance(text, str):
+            content_lines.append(f"<p>{escape_xml_text(text, quote=False)}</p>")
+        else:
+            content_lines.append(f'<div class="{escape_xml_text(element_type)}"></div>')
+    xhtml_content = XHTML_PAGE_TEMPLATE.format(content="\n".join(f"        {line}" for line in content_lines))
+    assert is_well_formed_xhtml(xhtml_content), "Local XHTML rendering produced malformed markup"
+    return xhtml_content
+
+def is_well_formed_xhtml(xhtml_content: str) -> bool:
+    """
+    Checks that ``xhtml_content`` parses as XML with lxml's C parser. The DOCTYPE's external DTD
+    is not fetched, so this catches malformed markup rather than doing full XHTML 1.1 validation.
+    """
+    # lxml parsers must not be shared between threads, and pages are refined concurrently
+    parser = etree.XMLParser(recover=False, no_network=True, resolve_entities=False)
+    try:
+        etree.fromstring(xhtml_content.encode("utf-8"), parser=parser)
+    except etree.XMLSyntaxError:
+        return False
+    return True
+
+# Model used for XHTML refinement
+LLM_MODEL = "gpt-4o-mini" # Consider making this configurable
+
+# Prompt cache routing keys for requests using SYSTEM_PROMPT and BATCH_SYSTEM_PROMPT respectively.
+# Bump the version suffix whenever the corresponding prompt changes.
+PROMPT_CACHE_KEY = "pdf-to-epub-page-xhtml-v1"
+BATCH_PROMPT_CACHE_KEY = "pdf-to-epub-batch-xhtml-v1"
+
+# Number of LLM requests made for a page before falling back to local rendering when
+# the returned XHTML is not well-formed
+LLM_XHTML_ATTEMPTS = 2
+
+def get_xhtml_cache_path(cache_dir: Path, page_json_for_llm: str) -> Path:
+    """
+    Returns the cache file for the LLM-refined XHTML of a page. The key hashes the model, the
+    system prompt and the page's JSON, so changing one page does not invalidate the others.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    for part in (LLM_MODEL, SYSTEM_PROMPT, page_json_for_llm):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return cache_dir / f"{digest.hexdigest()}.xhtml"
+
+def read_cached_xhtml(cache_path: Path | None) -> str | None:
+    """
+    Returns the cached XHTML at ``cache_path``, or None if caching is disabled or it is not cached.
+    Unreadable or malformed entries are treated as misses and removed.
+    """
+    if cache_path is None:
+        return None
+    try:
+        cached_xhtml = cache_path.read_text(encoding="utf-8")
+    except FileNotFoundError:
+        return None
+    except (OSError, UnicodeDecodeError):
+        cached_xhtml = None
+    if cached_xhtml is not None and is_well_formed_xhtml(cached_xhtml):
+        return cached_xhtml
+    print(f"Warning: Ignoring corrupt XHTML cache entry {cache_path}.")
+    try:
+        cache_path.unlink(missing_ok=True)
+    except OSError:
+        pass
+    return None
+
+def write_cached_xhtml(cache_path: Path | None, xhtml_content: str) -> None:
+    """Stores LLM-refined XHTML at ``cache_path``, replacing it atomically so concurrent runs never read partial entries."""
+    if cache_path is None:
+        return
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_text(xhtml_content, encoding="utf-8")
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Warning: Could not write XHTML cache entry {cache_path}: {e}")
+
 # Placeholder for LLM refinement functions
-def refine_page_to_xhtml(page_data: dict, page_number: int, client: openai.OpenAI, work_dir: Path, image_references: dict) -> Path | None:
+def refine_page_to_xhtml(page_data: dict, page_number: int, client: openai.OpenAI, work_dir: Path, image_references: dict, cache_dir: Path | None = None) -> Path | None:
     """
     Refines a single page's layout data to XHTML using an LLM.
 
@@ -212,86 +649,198 @@ def refine_page_to_xhtml(page_data: dict, page_number: int, client: openai.OpenA
         client: An instance of openai.OpenAI.
         work_dir: The base working directory (where OEBPS is).
         image_references: Dictionary mapping original image refs to EPUB-relative paths.
+        cache_dir: Directory caching refined XHTML across runs, or None to disable caching.
 
     Returns:
         Path to the generated XHTML file, or None on failure.
     """
-    import copy # For deepcopy
+    page_data_for_llm = prepare_page_for_llm(page_data, page_number, image_references)
+    page_json_for_llm = dumps_json_compact(page_data_for_llm)
 
-    page_data_for_llm = copy.deepcopy(page_data)
+    cache_path = get_xhtml_cache_path(cache_dir, page_json_for_llm) if cache_dir else None
+    cached_xhtml = read_cached_xhtml(cache_path)
+    if cached_xhtml is not None:
+        print(f"Using cached XHTML for page {page_number}.")
+        return save_page_xhtml(cached_xhtml, page_number, work_dir)
 
-    # Update image refs in page_data_for_llm for the prompt
-    # The LLM prompt expects {{ref}} to be the filename part, e.g., "image1.png"
-    # and will construct <img src="../Images/{{ref}}"/>
-    # image_references maps: original_ref -> "Images/new_filename.png"
-    if 'elements' in page_data_for_llm:
-        for element in page_data_for_llm['elements']:
-            if element.get('type') == 'image':
-                original_ref = element.get('ref')
-                if original_ref and original_ref in image_references:
-                    # image_references stores "Images/new_filename.png"
-                    # We need to extract "new_filename.png" for the LLM prompt's {{ref}}
-                    epub_image_path_str = image_references[original_ref]
-                    # Use Path to easily get the filename
-                    element['ref'] = Path(epub_image_path_str).name
-                elif original_ref:
-                    # If not in map, maybe it's already a filename or a placeholder?
-                    # For safety, make it just the filename if it looks like a path.
-                    element['ref'] = Path(original_ref).name
-                    print(f"Warning: Image ref '{original_ref}' for page {page_number} not found in image_references map. Using filename directly: {element['ref']}")
-                # If original_ref is None or empty, it will be handled by the LLM's generic rule or omitted.
-
-    page_json_for_llm = json.dumps(page_data_for_llm, indent=2)
-    full_prompt = f"{SYSTEM_PROMPT}\n\n{page_json_for_llm}"
+    for attempt in range(1, LLM_XHTML_ATTEMPTS + 1):
+        try:
+            print(f"Sending page {page_number} data to LLM for XHTML conversion...")
+            completion = client.chat.completions.create(
+                model=LLM_MODEL,
+                # SYSTEM_PROMPT is kept byte-identical across requests so that OpenAI's automatic
+                # prompt caching can reuse it; only the user message changes per page.
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": page_json_for_llm}
+                ],
+                # Routes requests sharing SYSTEM_PROMPT to the same prompt cache. Passed through
+                # extra_body because the pinned openai SDK predates the prompt_cache_key argument.
+                extra_body={"prompt_cache_key": PROMPT_CACHE_KEY}
+            )
 
-    try:
-        print(f"Sending page {page_number} data to LLM for XHTML conversion...")
-        completion = client.chat.completions.create(
-            model="gpt-4o-mini", # Consider making this configurable
-            messages=[
-                {"role": "system", "content": full_prompt}
-                # Alternatively, can split:
-                # {"role": "system", "content": SYSTEM_PROMPT},
-                # {"role": "user", "content": page_json_for_llm}
-            ]
-        )
+            xhtml_content = completion.choices[0].message.content
+            if not xhtml_content:
+                print(f"Error: LLM returned empty content for page {page_number}.")
+                break
 
-        xhtml_content = completion.choices[0].message.content
-        if not xhtml_content:
-            print(f"Error: LLM returned empty content for page {page_number}.")
-            return None
-
-        # Ensure the output is stripped of potential markdown backticks if LLM wraps it
-        if xhtml_content.startswith("```xml"): # Or ```xhtml
-            xhtml_content = xhtml_content[len("```xml"):]
-            if xhtml_content.endswith("```"):
-                xhtml_content = xhtml_content[:-len("```")]
-        elif xhtml_content.startswith("```"): # Generic backtick
-             xhtml_content = xhtml_content[len("```"):]
-             if xhtml_content.endswith("```"):
-                xhtml_content = xhtml_content[:-len("```")]
-        xhtml_content = xhtml_content.strip()
-
-
-    except openai.APIError as e:
-        print(f"OpenAI API error for page {page_number}: {e}")
-        return None
-    except Exception as e:
-        print(f"Error during LLM call for page {page_number}: {e}")
-        return None
+            # Ensure the output is stripped of potential markdown backticks if LLM wraps it
+            xhtml_content = clean_llm_xhtml(xhtml_content)
 
-    text_dir = work_dir / "OEBPS" / "Text"
-    text_dir.mkdir(parents=True, exist_ok=True) # Ensure Text directory exists
-    xhtml_file_path = text_dir / f"page_{page_number:04d}.xhtml"
+        except openai.APIError as e:
+            print(f"OpenAI API error for page {page_number}: {e}")
+            break
+        except Exception as e:
+            print(f"Error during LLM call for page {page_number}: {e}")
+            break
 
-    try:
-        with open(xhtml_file_path, "w", encoding="utf-8") as f:
-            f.write(xhtml_content)
-        print(f"Saved XHTML for page {page_number} to: {xhtml_file_path}")
-        return xhtml_file_path
-    except IOError as e:
-        print(f"Error writing XHTML file for page {page_number} at {xhtml_file_path}: {e}")
-        return None
+        if is_well_formed_xhtml(xhtml_content):
+            write_cached_xhtml(cache_path, xhtml_content)
+            return save_page_xhtml(xhtml_content, page_number, work_dir)
+        print(f"Warning: LLM returned malformed XHTML for page {page_number} (attempt {attempt} of {LLM_XHTML_ATTEMPTS}).")
+
+    # Reached on API errors, empty responses and repeatedly malformed XHTML alike, so the page
+    # is never left out of the EPUB
+    print(f"Falling back to local XHTML rendering for page {page_number}.")
+    return save_page_xhtml(render_simple_page_xhtml(page_data_for_llm), page_number, work_dir)
+
+def refine_pages_batch(numbered_pages: list[tuple[int, dict]], client: openai.OpenAI, work_dir: Path, image_references: dict, cache_dir: Path | None = None) -> dict[int, Path]:
+    """
+    Refines several pages to XHTML with a single LLM request, amortizing the per-request
+    network overhead. Cached pages are not sent, and pages missing from the response are
+    retried one at a time.
+
+    Args:
+        numbered_pages: (page_number, page_data) pairs for the pages in this batch.
+        client: An instance of openai.OpenAI.
+        work_dir: The base working directory (where OEBPS is).
+        image_references: Dictionary mapping original image refs to EPUB-relative paths.
+        cache_dir: Directory caching refined XHTML across runs, or None to disable caching.
+
+    Returns:
+        A dictionary mapping page numbers to the generated XHTML files.
+    """
+    if len(numbered_pages) == 1:
+        page_number, page_data = numbered_pages[0]
+        xhtml_path = refine_page_to_xhtml(page_data, page_number, client, work_dir, image_references, cache_dir)
+        return {page_number: xhtml_path} if xhtml_path else {}
+
+    xhtml_by_page = {}
+    pages_for_llm = []
+    cache_paths = {}
+    for page_number, page_data in numbered_pages:
+        page_data_for_llm = prepare_page_for_llm(page_data, page_number, image_references)
+        if cache_dir:
+            # Keyed on the single-page JSON so entries are shared with refine_page_to_xhtml
+            cache_paths[page_number] = get_xhtml_cache_path(cache_dir, dumps_json_compact(page_data_for_llm))
+            cached_xhtml = read_cached_xhtml(cache_paths[page_number])
+            if cached_xhtml is not None:
+                print(f"Using cached XHTML for page {page_number}.")
+                xhtml_path = save_page_xhtml(cached_xhtml, page_number, work_dir)
+                if xhtml_path:
+                    xhtml_by_page[page_number] = xhtml_path
+                    continue
+        pages_for_llm.append({**page_data_for_llm, 'page_no': page_number})
+
+    page_numbers = [page['page_no'] for page in pages_for_llm]
+    if len(pages_for_llm) > 1:
+        pages_json_for_llm = dumps_json_compact(pages_for_llm)
+        try:
+            print(f"Sending pages {page_numbers} data to LLM for XHTML conversion...")
+            completion = client.chat.completions.create(
+                model=LLM_MODEL,
+                messages=[
+                    {"role": "system", "content": BATCH_SYSTEM_PROMPT},
+                    {"role": "user", "content": pages_json_for_llm}
+                ],
+                extra_body={"prompt_cache_key": BATCH_PROMPT_CACHE_KEY}
+            )
+            response_content = completion.choices[0].message.content or ""
+
+            for match in PAGE_SENTINEL_RE.finditer(response_content):
+                page_number = int(match.group(1))
+                xhtml_content = clean_llm_xhtml(match.group(2))
+                if page_number in page_numbers and xhtml_content and is_well_formed_xhtml(xhtml_content):
+                    write_cached_xhtml(cache_paths.get(page_number), xhtml_content)
+                    xhtml_path = save_page_xhtml(xhtml_content, page_number, work_dir)
+                    if xhtml_path:
+                        xhtml_by_page[page_number] = xhtml_path
+        except openai.APIError as e:
+            print(f"OpenAI API error for pages {page_numbers}: {e}")
+        except Exception as e:
+            print(f"Error during LLM call for pages {page_numbers}: {e}")
+
+    for page_number, page_data in numbered_pages:
+        if page_number not in xhtml_by_page:
+            if len(pages_for_llm) > 1:
+                print(f"Warning: Batched LLM response did not contain well-formed XHTML for page {page_number}. Retrying it on its own.")
+            xhtml_path = refine_page_to_xhtml(page_data, page_number, client, work_dir, image_references, cache_dir)
+            if xhtml_path:
+                xhtml_by_page[page_number] = xhtml_path
+
+    return xhtml_by_page
+
+def refine_pages_to_xhtml(pages_data: list[dict], client: openai.OpenAI | None, work_dir: Path, image_references: dict, max_workers: int = 16, pages_per_request: int = 1, cache_dir: Path | None = None) -> list[Path]:
+    """
+    Converts all pages to XHTML. Pages made only of text, headings, images and lists are
+    rendered locally; the rest are refined by the LLM. Each LLM request is an independent,
+    network-bound call, so requests are dispatched on a thread pool instead of one after another.
+
+    Args:
+        pages_data: The list of page dictionaries from layout_data['pages'].
+        client: An instance of openai.OpenAI (shared across worker threads), or None to render
+            every page locally without the LLM.
+        work_dir: The base working directory (where OEBPS is).
+        image_references: Dictionary mapping original image refs to EPUB-relative paths.
+        max_workers: Upper bound on the number of concurrent LLM requests.
+        pages_per_request: Number of pages sent to the LLM in each request.
+        cache_dir: Directory caching LLM-refined XHTML across runs, or None to disable caching.
+
+    Returns:
+        Paths to the generated XHTML files, sorted by page number.
+    """
+    if not pages_data:
+        return []
+
+    # Ensure Text directory exists once, rather than on every page write
+    (work_dir / "OEBPS" / "Text").mkdir(parents=True, exist_ok=True)
+
+    xhtml_by_page = {}
+    numbered_pages = []
+    for i, page_content in enumerate(pages_data):
+        actual_page_number = page_content.get('page_no', i + 1)
+        if is_simple_page(page_content):
+            page_data_for_llm = prepare_page_for_llm(page_content, actual_page_number, image_references)
+            xhtml_path = save_page_xhtml(render_simple_page_xhtml(page_data_for_llm), actual_page_number, work_dir)
+            if xhtml_path:
+                xhtml_by_page[actual_page_number] = xhtml_path
+        else:
+            numbered_pages.append((actual_page_number, page_content))
+
+    if numbered_pages and client is None:
+        print(f"No OpenAI client available: rendering {len(numbered_pages)} complex page(s) locally with generic markup.")
+        for actual_page_number, page_content in numbered_pages:
+            page_data_for_llm = prepare_page_for_llm(page_content, actual_page_number, image_references)
+            xhtml_path = save_page_xhtml(render_simple_page_xhtml(page_data_for_llm), actual_page_number, work_dir)
+            if xhtml_path:
+                xhtml_by_page[actual_page_number] = xhtml_path
+        numbered_pages = []
+
+    if numbered_pages:
+        print(f"Rendered {len(xhtml_by_page)} page(s) locally; sending {len(numbered_pages)} page(s) to the LLM.")
+
+    pages_per_request = max(1, pages_per_request)
+    batches = [numbered_pages[i:i + pages_per_request] for i in range(0, len(numbered_pages), pages_per_request)]
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(batches)))) as executor:
+        futures = [
+            executor.submit(refine_pages_batch, batch, client, work_dir, image_references, cache_dir)
+            for batch in batches
+        ]
+        for future in as_completed(futures):
+            xhtml_by_page.update(future.result())
+
+    return [xhtml_by_page[page_number] for page_number in sorted(xhtml_by_page)]
 
 # Placeholder for EPUB packaging functions
 def create_global_stylesheet(stylesheet_path: Path) -> None:
@@ -367,19 +916,64 @@ img {
     except IOError as e:
         print(f"Error writing stylesheet to {stylesheet_path}: {e}")
 
-def get_image_media_type(image_filename: str) -> str:
-    """Determines the media type for an image based on its extension."""
-    ext = Path(image_filename).suffix.lower()
-    if ext == ".jpg" or ext == ".jpeg":
-        return "image/jpeg"
-    elif ext == ".png":
-        return "image/png"
-    elif ext == ".gif":
-        return "image/gif"
-    elif ext == ".svg":
-        return "image/svg+xml"
-    else:
-        return "application/octet-stream" # Fallback
+# Image media types by lower-cased file extension
+IMAGE_MEDIA_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".gif": "image/gif",
+    ".svg": "image/svg+xml",
+}
+
+def get_media_type_for_suffix(ext: str) -> str:
+    """Determines the media type for an image from its already lower-cased extension (e.g. ".png")."""
+    return IMAGE_MEDIA_TYPES.get(ext, "application/octet-stream") # Fallback
+
+class FileBackedEpubItem(epub.EpubItem):
+    """
+    An ``EpubItem`` whose content stays on disk until the EPUB is written, so large assets
+    such as images are never all held in memory at once.
+    """
+    def __init__(self, source_path: Path, **kwargs):
+        super().__init__(**kwargs)
+        self.source_path = source_path
+
+    def get_content(self, default=b''):
+        return self.source_path.read_bytes()
+
+# Formats that are already compressed; deflating them again costs CPU for almost no size gain
+PRECOMPRESSED_MEDIA_TYPES = {"image/png", "image/jpeg", "image/gif"}
+
+class StreamingEpubWriter(epub.EpubWriter):
+    """
+    An ``EpubWriter`` that copies ``FileBackedEpubItem`` files straight into the zip archive
+    with ``ZipFile.write`` (chunked reads) instead of building each one as an in-memory bytes object.
+    Already-compressed images are stored rather than deflated.
+    """
+    def _write_items(self):
+        # Mirrors ebooklib's EpubWriter._write_items with an extra branch for file-backed items
+        for item in self.book.get_items():
+            if isinstance(item, FileBackedEpubItem):
+                compress_type = zipfile.ZIP_STORED if item.media_type in PRECOMPRESSED_MEDIA_TYPES else None
+                self.out.write(item.source_path, f"{self.book.FOLDER_NAME}/{item.file_name}", compress_type=compress_type)
+            elif isinstance(item, epub.EpubNcx):
+                self.out.writestr(f"{self.book.FOLDER_NAME}/{item.file_name}", self._get_ncx())
+            elif isinstance(item, epub.EpubNav):
+                self.out.writestr(f"{self.book.FOLDER_NAME}/{item.file_name}", self._get_nav(item))
+            elif item.manifest:
+                self.out.writestr(f"{self.book.FOLDER_NAME}/{item.file_name}", item.get_content())
+            else:
+                self.out.writestr(item.file_name, item.get_content())
+
+def add_items_to_book(book: epub.EpubBook, items: list) -> None:
+    """
+    Adds items to ``book`` with a single list extend. Equivalent to calling ``book.add_item``
+    for each item, except that nothing is guessed: every item must be created with its uid and
+    media type set (``EpubHtml`` defaults to an empty media type).
+    """
+    for item in items:
+        item.book = book
+    book.items.extend(items)
 
 def create_epub_file(
     epub_path: Path,
@@ -394,8 +988,6 @@ def create_epub_file(
     """
     Creates an EPUB file from the generated XHTML, images, and CSS.
     """
-    from ebooklib import epub # Import here to keep it localized if needed
-
     book = epub.EpubBook()
     book.set_title(title)
     book.set_language(language)
@@ -420,14 +1012,16 @@ def create_epub_file(
     # Add XHTML items and link CSS
     epub_xhtml_items = []
     for xhtml_file_path in xhtml_file_paths: # These are absolute paths
+        xhtml_stem = xhtml_file_path.stem # e.g., "page_0001"
         # file_name for EpubHtml should be relative to OEBPS root, e.g., "Text/page_0001.xhtml"
         xhtml_oebps_filename = f"Text/{xhtml_file_path.name}"
 
         item = epub.EpubHtml(
-            uid=xhtml_file_path.stem, # Unique ID for the item, e.g., "page_0001"
+            uid=xhtml_stem, # Unique ID for the item, e.g., "page_0001"
             file_name=xhtml_oebps_filename,
-            title=xhtml_file_path.stem.replace("_", " ").title(), # Simple title from filename
-            language=language
+            title=xhtml_stem.replace("_", " ").title(), # Simple title from filename
+            lang=language,
+            media_type="application/xhtml+xml" # add_items_to_book does not guess it like book.add_item
         )
         item.content = xhtml_file_path.read_bytes()
 
@@ -435,30 +1029,33 @@ def create_epub_file(
             # Relative path from Text/page.xhtml to Styles/style.css is ../Styles/style.css
             # css_path_within_oebps is "Styles/style.css"
             # So, Link href should be "../" + css_path_within_oebps
-            item.add_link(epub.Link(href=f"../{css_path_within_oebps}", rel="stylesheet", type="text/css"))
+            item.add_link(href=f"../{css_path_within_oebps}", rel="stylesheet", type="text/css")
 
-        book.add_item(item)
         epub_xhtml_items.append(item)
 
     # Add Image items
     # image_paths_within_oebps contains paths like "Images/pic1.png"
+    oebps_dir = work_dir / "OEBPS"
+    image_items = []
     for img_oebps_path_str in image_paths_within_oebps:
-        img_full_path = work_dir / "OEBPS" / img_oebps_path_str
+        img_full_path = oebps_dir / img_oebps_path_str # Same stem/suffix as img_oebps_path_str
         if img_full_path.exists():
-            media_type = get_image_media_type(img_oebps_path_str)
-            img_item = epub.EpubItem(
-                uid=Path(img_oebps_path_str).stem, # Unique ID, e.g., "pic1"
+            media_type = get_media_type_for_suffix(img_full_path.suffix.lower())
+            img_item = FileBackedEpubItem(
+                source_path=img_full_path,       # Streamed into the EPUB at write time
+                uid=img_full_path.stem,          # Unique ID, e.g., "pic1"
                 file_name=img_oebps_path_str,    # Path within EPUB (relative to OEBPS)
-                media_type=media_type,
-                content=img_full_path.read_bytes()
+                media_type=media_type
             )
-            book.add_item(img_item)
+            image_items.append(img_item)
         else:
             print(f"Warning: Image file not found at {img_full_path}. It will be missing from EPUB.")
 
+    add_items_to_book(book, epub_xhtml_items + image_items)
+
     # Create Table of Contents (ToC)
     if epub_xhtml_items: # Ensure there are items for the ToC
-        book.toc = tuple([epub.Link(item.file_name, item.title, item.uid) for item in epub_xhtml_items])
+        book.toc = tuple(epub.Link(item.file_name, item.title, item.id) for item in epub_xhtml_items)
     else:
         book.toc = () # Empty ToC if no XHTML files
         print("Warning: No XHTML items to add to Table of Contents.")
@@ -477,7 +1074,10 @@ def create_epub_file(
 
     # Write EPUB file
     try:
-        epub.write_epub(epub_path, book, {})
+        # Equivalent to epub.write_epub(), but streams file-backed items from disk
+        writer = StreamingEpubWriter(str(epub_path), book, {})
+        writer.process()
+        writer.write()
         print(f"EPUB successfully created at: {epub_path}")
     except Exception as e:
         print(f"Error writing EPUB file to {epub_path}: {e}")
@@ -499,6 +1099,77 @@ if __name__ == "__main__":
         default=None,
         help="Path to save the output EPUB file. Defaults to '[pdf_filename].epub'."
     )
+    parser.add_argument(
+        "--max_workers",
+        "-w",
+        type=int,
+        default=16,
+        help="Maximum number of concurrent LLM requests. Defaults to 16."
+    )
+    parser.add_argument(
+        "--pages_per_request",
+        type=int,
+        default=4,
+        help="Number of pages converted to XHTML per LLM request. Defaults to 4."
+    )
+    parser.add_argument(
+        "--png_compress_level",
+        type=int,
+        choices=range(10),
+        default=1,
+        help="PNG compression level (0-9) for extracted images. Defaults to 1 (fast)."
+    )
+    parser.add_argument(
+        "--max_image_dim",
+        type=non_negative_int,
+        default=1600,
+        help="Downscale extracted images larger than this many pixels on their longest side. Use 0 to keep the original size. Defaults to 1600."
+    )
+    parser.add_argument(
+        "--dump_layout",
+        action="store_true",
+        help="Save the parsed PDF layout as layout.json in the working directory (for debugging). Implies --keep_work_dir."
+    )
+    parser.add_argument(
+        "--keep_work_dir",
+        action="store_true",
+        help="Keep the temporary working directory after the conversion (for debugging)."
+    )
+    parser.add_argument(
+        "--no_llm",
+        action="store_true",
+        help="Render every page to XHTML locally instead of refining complex pages with the LLM."
+    )
+    parser.add_argument(
+        "--llm_cache_dir",
+        type=str,
+        default=str(Path("~") / ".cache" / "pdf_to_epub" / "xhtml"),
+        help="Directory caching LLM-refined page XHTML between runs. Pass an empty string to disable. Defaults to '~/.cache/pdf_to_epub/xhtml'."
+    )
+    parser.add_argument(
+        "--ocr",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Run OCR while parsing the PDF. Use --no-ocr for PDFs that already have a text layer."
+    )
+    parser.add_argument(
+        "--table_mode",
+        choices=["fast", "accurate"],
+        default="fast",
+        help="Table structure recognition mode. Defaults to 'fast'."
+    )
+    parser.add_argument(
+        "--num_threads",
+        type=int,
+        default=os.cpu_count() or 4,
+        help="Number of threads Docling uses for model inference. Defaults to the CPU count."
+    )
+    parser.add_argument(
+        "--device",
+        type=parse_device,
+        default="auto",
+        help="Device for Docling model inference: auto, cpu, cuda, cuda:N or mps. Defaults to 'auto'."
+    )
     args = parser.parse_args()
 
     cli_pdf_path = Path(args.pdf_path)
@@ -518,90 +1189,100 @@ if __name__ == "__main__":
     work_dir = create_epub_directories()
     print(f"EPUB directory structure created at: {work_dir}")
 
-    oebps_dir = work_dir / "OEBPS"
-    images_dir = oebps_dir / "Images"
-    styles_dir = oebps_dir / "Styles"
-
-    doc_object_from_parse = None
-    layout_json_data = {}
-    image_references_map = {}
-    xhtml_files = []
-
-    openai_client = None
-    if os.getenv("OPENAI_API_KEY"):
-        try:
-            openai_client = openai.OpenAI()
-        except Exception as e:
-            print(f"Failed to initialize OpenAI client: {e}. LLM refinement will be skipped.")
-    else:
-        print("Warning: OPENAI_API_KEY environment variable not set. LLM calls will be skipped.")
-
-    stylesheet_save_path = styles_dir / "style.css"
-    create_global_stylesheet(stylesheet_save_path)
-
-    print(f"Attempting to parse PDF: {cli_pdf_path}")
-    doc_object_from_parse, layout_json_data = parse_pdf_to_layout_json(cli_pdf_path, work_dir)
+    try:
+        oebps_dir = work_dir / "OEBPS"
+        images_dir = oebps_dir / "Images"
+        styles_dir = oebps_dir / "Styles"
+
+        doc_object_from_parse = None
+        layout_json_data = {}
+        image_references_map = {}
+        xhtml_files = []
+
+        openai_client = None
+        if args.no_llm:
+            print("LLM refinement disabled (--no_llm). All pages will be rendered locally.")
+        elif os.getenv("OPENAI_API_KEY"):
+            try:
+                openai_client = create_openai_client()
+            except Exception as e:
+                print(f"Failed to initialize OpenAI client: {e}. LLM refinement will be skipped.")
+        else:
+            print("Warning: OPENAI_API_KEY environment variable not set. LLM calls will be skipped.")
 
-    if doc_object_from_parse and layout_json_data:
-        print("PDF parsed and layout.json saved successfully.")
+        stylesheet_save_path = styles_dir / "style.css"
+        create_global_stylesheet(stylesheet_save_path)
 
-        print(f"Attempting to extract images to: {images_dir}")
-        image_references_map = extract_and_save_images(doc_object_from_parse, layout_json_data, images_dir)
+        print(f"Attempting to parse PDF: {cli_pdf_path}")
+        pdf_pipeline_options = build_pdf_pipeline_options(
+            do_ocr=args.ocr,
+            table_mode=args.table_mode,
+            num_threads=args.num_threads,
+            device=args.device
+        )
+        doc_object_from_parse, layout_json_data = parse_pdf_to_layout_json(
+            cli_pdf_path, work_dir, dump_layout=args.dump_layout, pipeline_options=pdf_pipeline_options
+        )
 
-        if image_references_map:
-            print("Image extraction attempt finished. References:")
-            for ref, path_val in image_references_map.items():
-                print(f"  {ref} -> {path_val}")
-        else:
-            print("No images were extracted or mapped.")
+        if doc_object_from_parse and layout_json_data:
+            print("PDF parsed successfully.")
 
-        if openai_client and layout_json_data.get('pages'):
-            print("\nStarting LLM refinement for page content to XHTML...")
-            pages_layout_data = layout_json_data.get('pages', [])
-            for i, page_content_from_layout in enumerate(pages_layout_data):
-                actual_page_number = page_content_from_layout.get('page_no', i + 1)
+            print(f"Attempting to extract images to: {images_dir}")
+            image_references_map = extract_and_save_images(
+                doc_object_from_parse, layout_json_data, images_dir,
+                png_compress_level=args.png_compress_level,
+                max_image_dim=args.max_image_dim or None
+            )
 
-                xhtml_path = refine_page_to_xhtml(
-                    page_content_from_layout, actual_page_number,
-                    openai_client, work_dir, image_references_map
+            if image_references_map:
+                print("Image extraction attempt finished. References:")
+                for ref, path_val in image_references_map.items():
+                    print(f"  {ref} -> {path_val}")
+            else:
+                print("No images were extracted or mapped.")
+
+            if layout_json_data.get('pages'):
+                if not openai_client and not args.no_llm:
+                    print("OpenAI client not available or API key not set. All pages will be rendered locally.")
+                print("\nStarting conversion of page content to XHTML...")
+                pages_layout_data = layout_json_data.get('pages', [])
+                xhtml_files = refine_pages_to_xhtml(
+                    pages_layout_data, openai_client, work_dir, image_references_map,
+                    max_workers=args.max_workers,
+                    pages_per_request=args.pages_per_request,
+                    cache_dir=Path(args.llm_cache_dir).expanduser() if args.llm_cache_dir else None
                 )
-                if xhtml_path:
-                    xhtml_files.append(xhtml_path)
+
+                if xhtml_files:
+                    print("\nGenerated XHTML files:")
+                    for xp in xhtml_files: print(f"  {xp}")
+                else:
+                    print("No XHTML files were generated.")
+            else:
+                print("No page data available in layout_json_data for XHTML conversion.")
 
             if xhtml_files:
-                print("\nGenerated XHTML files:")
-                for xp in xhtml_files: print(f"  {xp}")
+                book_title_cli = cli_pdf_path.stem
+                image_oebps_paths_list_cli = list(dict.fromkeys(image_references_map.values())) # Shared images appear once
+                css_oebps_relative_path_cli = str(stylesheet_save_path.relative_to(oebps_dir))
+
+                create_epub_file(
+                    epub_path=cli_output_epub_path,
+                    title=book_title_cli,
+                    language="en",
+                    identifier=f"urn:uuid:{book_title_cli}-{os.urandom(4).hex()}",
+                    xhtml_file_paths=xhtml_files,
+                    image_paths_within_oebps=image_oebps_paths_list_cli,
+                    css_path_within_oebps=css_oebps_relative_path_cli,
+                    work_dir=work_dir
+                )
             else:
-                print("No XHTML files were generated by the LLM process.")
-        elif not openai_client:
-            print("OpenAI client not available or API key not set. Skipping LLM refinement.")
+                print("No XHTML files were generated, skipping EPUB packaging.")
         else:
-            print("No page data available in layout_json_data for LLM refinement.")
-
-        if xhtml_files:
-            book_title_cli = cli_pdf_path.stem
-            image_oebps_paths_list_cli = list(image_references_map.values())
-            css_oebps_relative_path_cli = str(stylesheet_save_path.relative_to(oebps_dir))
-
-            create_epub_file(
-                epub_path=cli_output_epub_path,
-                title=book_title_cli,
-                language="en",
-                identifier=f"urn:uuid:{book_title_cli}-{os.urandom(4).hex()}",
-                xhtml_file_paths=xhtml_files,
-                image_paths_within_oebps=image_oebps_paths_list_cli,
-                css_path_within_oebps=css_oebps_relative_path_cli,
-                work_dir=work_dir
-            )
+            print("PDF parsing failed or returned no data. Cannot proceed with EPUB generation.")
+    finally:
+        # layout.json is written into work_dir, so keep it when the layout was dumped
+        if args.keep_work_dir or args.dump_layout:
+            print(f"Temporary directory {work_dir} not removed for inspection.")
         else:
-            print("No XHTML files were generated, skipping EPUB packaging.")
-    else:
-        print("PDF parsing failed or returned no data. Cannot proceed with EPUB generation.")
-
-    # import shutil
-    # if work_dir and work_dir.exists():
-    #     try:
-    #         # shutil.rmtree(work_dir)
-    #         print(f"Temporary directory {work_dir} not removed for inspection.")
-    #     except Exception as e:
-    #         print(f"Error cleaning up temporary directory {work_dir}: {e}")
+            shutil.rmtree(work_dir, ignore_errors=True)